@@ -4,6 +4,67 @@ from utils import infix_to_prefix
 
 # Manual: https://picture.iczhiku.com/resource/eetop/shIGapEosdWkLCxn.pdf
 
+# Default boolean behaviors accepted by sdegeo:set-default-boolean (see SDE_generator.preamble)
+_VALID_BOOLEANS = frozenset({"AB", "ABA", "BAB", "ABiA", "ABiB", "XX"})
+
+# Coordinate types for which '%.3e' formatting gives the same result as format(coord, '.3e').
+# Other numbers (ex: Decimal) go through SDE_generator._coord_to_str.
+_FAST_NUMERIC_TYPES = (int, float)
+
+# Static comment blocks, written as a whole when comments are enabled
+_PREAMBLE_COMMENT = """\
+; SDE file created by pysde_sentaurus.
+; The sde file is the file that constructs the structure to be simulated.
+; This includes defining the regions, its doping and the mesh.
+
+; ******************
+; INITIAL SETUP
+
+"""
+
+_WORKBENCH_VARIABLES_COMMENT = """\
+; ******************
+; PARAMETER DEFINITION
+
+; We can directly specify variables from the script or take them from the Sentaurus Workbench.
+; NOTE: length variables are in um by default in Sentaurus.
+
+; 1. Specify a given variable from the Sentaurus Workbench. This has the advantage that we can very easily do parameter sweeps.
+; ---------------------------------------------
+
+"""
+
+_SCRIPT_VARIABLES_COMMENT = """\
+; 2. Specify a variable from the script
+; -------------------------------------
+
+"""
+
+_DOPING_DEFINITIONS_COMMENT = """\
+; ******************
+; DOPINGS
+; Specify the doping species and doping concentration for each region.
+
+; Step 1: generate all the different doping types existing in the structure
+; -------------------------------------------------------------------------
+"""
+
+_DOPING_ASSIGNMENTS_COMMENT = """\
+; Step 2: assign the doping layers to the different regions
+; ----------------------------------------------------------
+"""
+
+_CONTACTS_COMMENT = """\
+; ******************
+; DEFINE THE CONTACTS
+"""
+
+_MESHING_COMMENT = """\
+; ******************
+; MESHING 
+
+"""
+
 class SDE_generator():
     """ Base class to write the .cmd file.
 
@@ -27,12 +88,33 @@ class SDE_generator():
         self.sim_type = sim_type
         self.comment = comment
 
-        if os.path.exists(os.path.join(path, filename)) and not overwrite:
-            # The file already exists. Throw an error
-            raise FileExistsError('There is already a file with the specified name in the specifed path')
+        # Resolve the dimension-dependent pieces once, so that the geometry methods do not need
+        # to check self.sim_type on every call. _point_to_str is bound directly to the 2D/3D
+        # implementation, unless a subclass overrides _point_to_str itself.
+        bind_point_to_str = type(self)._point_to_str is SDE_generator._point_to_str
+        if sim_type == '2D':
+            if bind_point_to_str:
+                self._point_to_str = self._point_to_str_2d
+            self._rectangle_cmd = 'create-rectangle'
+            self._circle_cmd = 'create-circular-sheet'
+        else:
+            if bind_point_to_str:
+                self._point_to_str = self._point_to_str_3d
+            self._rectangle_cmd = 'create-cuboid'
+            self._circle_cmd = 'create-sphere'
+
+        # Open the file we will write. If we cannot overwrite, exclusive creation fails if the file already exists
+        mode = "w" if overwrite else "x"
+        try:
+            self.file = open(os.path.join(path, filename), mode)
+        except FileExistsError:
+            raise FileExistsError('There is already a file with the specified name in the specifed path') from None
 
-        # Open the file we will write
-        self.file = open(os.path.join(path, filename), "w")
+        # Expressions are accumulated in memory and written to the file in one go by postamble()
+        self._buf = []
+
+        # Formatted numeric coordinates. Layouts reuse the same values a lot.
+        self._fmt_cache = {}
 
     ######################### GENERIC #########################
 
@@ -42,12 +124,15 @@ class SDE_generator():
             self.write("; Generate the mesh")
         self.write('(sde:build-mesh "snmesh" "" "n@node@")')
 
-        # Close the file handle
+        # Dump the whole buffer to the file with a single write and close the file handle
+        self.file.write("".join(self._buf))
+        self._buf.clear()
         self.file.close()
 
     def write(self, expression, newline=True):
         """
-        Simply writes a scheme expression to the current end of file, adn adds an newline
+        Simply writes a scheme expression to the current end of file, adn adds an newline.
+        The file is not actually written until postamble() is called.
 
         :param expression: string with the exoression to write
         :param newline: if True, it adds a newline at the end of the expression
@@ -56,10 +141,18 @@ class SDE_generator():
         if expression == "\n":
             newline = False
 
+        self._buf.append(expression)
         if newline:
-            expression = expression + "\n"
+            self._buf.append("\n")
+
+    def writelines(self, lines):
+        """
+        Writes several scheme expressions at once, adding a newline to the ones that do not end with one.
 
-        self.file.write(expression)
+        :param lines: iterable of strings with the expressions to write
+        """
+
+        self._buf.extend(line if line.endswith("\n") else line + "\n" for line in lines)
 
     def preamble(self, clear=True, default_boolean="ABA"):
         """ Writes the preamble of the sde file.
@@ -80,13 +173,7 @@ class SDE_generator():
 
         if self.comment:
             # Initial comments
-            self.write("; SDE file created by pysde_sentaurus.")
-            self.write("; The sde file is the file that constructs the structure to be simulated.")
-            self.write("; This includes defining the regions, its doping and the mesh.")
-            self.write("\n")
-            self.write("; ******************")
-            self.write("; INITIAL SETUP")
-            self.write("\n")
+            self.write(_PREAMBLE_COMMENT, newline=False)
 
         if clear:
             if self.comment:
@@ -94,10 +181,9 @@ class SDE_generator():
             else:
                 self.write('(sde:clear)')
 
-        if default_boolean not in ["AB", "ABA", "BAB", "ABiA", "ABiB", "XX"]:
+        if default_boolean not in _VALID_BOOLEANS:
             raise ValueError('Indicated default boolean not recognized')
-        self.write('(sdegeo:set-default-boolean "%s")' % default_boolean)
-        self.write("\n")
+        self.writelines(('(sdegeo:set-default-boolean "%s")' % default_boolean, "\n"))
 
     def write_if_clause(self, condition, statements_true, statements_false=None, write_to_file=True):
         """ Writes an if clause in scheme.
@@ -123,23 +209,62 @@ class SDE_generator():
         else:
             return statements
 
+    def _coord_to_str(self, coord):
+        """ Converts a single coordinate (a number or a string with a variable or an operation) to a string.
+        """
+
+        if isinstance(coord, str):
+            # A single operand (only alphanumerics, '.' and '_') converts to itself
+            operand = coord.strip()
+            if operand.replace('_', '').replace('.', '').isalnum():
+                return operand
+            return infix_to_prefix(coord)
+
+        # Zeros are not cached, since 0.0 and -0.0 compare equal but format differently.
+        # The type is part of the key because equal values of different types can format differently.
+        if coord == 0:
+            return format(coord, '.3e')
+
+        key = (type(coord), coord)
+        s = self._fmt_cache.get(key)
+        if s is None:
+            s = format(coord, '.3e')
+            self._fmt_cache[key] = s
+        return s
+
     def _point_to_str(self, point):
-        """ Converts a point to a string.
+        """ Converts a point to a string, using the implementation for the simulation dimension.
+
+        __init__ replaces this method on the instance by _point_to_str_2d or _point_to_str_3d,
+        so subclasses should override those to customize the point conversion.
         """
 
         if self.sim_type == '2D':
-                point = (point[0], point[1], 0)
+            return self._point_to_str_2d(point)
+        return self._point_to_str_3d(point)
 
-        p = [0, 0, 0]
-        for i in range(len(point)):
-            if isinstance(point[i], str):
-                p[i] = infix_to_prefix(point[i])
-            else:
-                p[i] = format(point[i], '.3e')
-        
-        p_str = '(%s) (%s) (%s)' % (p[0], p[1], p[2])
+    def _point_to_str_2d(self, point):
+        """ Converts a point to a string in a 2D simulation. The third coordinate is always 0.
+        """
+
+        x, y = point[0], point[1]
+        if isinstance(x, _FAST_NUMERIC_TYPES) and isinstance(y, _FAST_NUMERIC_TYPES):
+            return "(%.3e) (%.3e) (0.000e+00)" % (x, y)
+
+        return '(%s) (%s) (0.000e+00)' % (self._coord_to_str(x), self._coord_to_str(y))
+
+    def _point_to_str_3d(self, point):
+        """ Converts a point to a string in a 3D simulation.
+        """
+
+        # A missing third coordinate is padded with 0
+        x, y = point[0], point[1]
+        z = point[2] if len(point) > 2 else 0.0
+        if isinstance(x, _FAST_NUMERIC_TYPES) and isinstance(y, _FAST_NUMERIC_TYPES) and isinstance(z, _FAST_NUMERIC_TYPES):
+            return "(%.3e) (%.3e) (%.3e)" % (x, y, z)
 
-        return p_str    
+        coord_to_str = self._coord_to_str
+        return '(%s) (%s) (%s)' % (coord_to_str(x), coord_to_str(y), coord_to_str(z))
     
     ######################### VARIABLES #########################
 
@@ -153,19 +278,13 @@ class SDE_generator():
         """
 
         if self.comment and write_to_file:
-            self.write("; ******************")
-            self.write("; PARAMETER DEFINITION")
-            self.write("\n")
-            self.write("; We can directly specify variables from the script or take them from the Sentaurus Workbench.")
-            self.write("; NOTE: length variables are in um by default in Sentaurus.")
-            self.write("\n")
-            self.write("; 1. Specify a given variable from the Sentaurus Workbench. This has the advantage that we can very easily do parameter sweeps.")
-            self.write("; ---------------------------------------------")
-            self.write("\n")
-
-        statements = ""
+            self.write(_WORKBENCH_VARIABLES_COMMENT, newline=False)
+
+        parts = []
+        append = parts.append
         for var in vars:
-            statements = statements + "(define %s @%s@) \n" % (var, var)
+            append("(define %s @%s@) \n" % (var, var))
+        statements = "".join(parts)
 
         if write_to_file:
             self.write(statements)
@@ -182,15 +301,14 @@ class SDE_generator():
         """
 
         if self.comment and write_to_file:
+            self.write(_SCRIPT_VARIABLES_COMMENT, newline=False)
 
-            self.write("; 2. Specify a variable from the script")
-            self.write("; -------------------------------------")
-            self.write("\n")
-
-        statements = ""
+        parts = []
+        append = parts.append
 
         for var_name, var_val in var_dict.items():
-            statements = statements + "(define %s %.5e) \n" % (var_name, var_val)
+            append("(define %s %.5e) \n" % (var_name, var_val))
+        statements = "".join(parts)
 
         if write_to_file:
             self.write(statements)
@@ -217,31 +335,20 @@ class SDE_generator():
         :param write_to_file: if True, it writes the satements to the file. If False, it just returns the statements.
         """
 
-        if self.comment and write_to_file:
-            self.write("; ******************")
-            self.write("; DOPINGS")
-            self.write("Specify the doping species and doping concentration for each region.")
-            self.write("\n")
-            self.write("; Step 1: generate all the different doping types existing in the structure")
-            self.write("; -------------------------------------------------------------------------")
-        
-        statements = ""
-        statements = statements + self._constant_doping_definitions(doping_types, p_dopant, n_dopant)
-        statements = statements + "\n"
+        definitions = self._constant_doping_definitions(doping_types, p_dopant, n_dopant)
+        assignments = self._doping_assignments(region_doping)
 
-        if self.comment and write_to_file:
+        if not write_to_file:
+            return definitions + "\n" + assignments + "\n"
 
-            self.write("; Step 2: assign the doping layers to the different regions")
-            self.write("; ----------------------------------------------------------")
+        if self.comment:
+            self.write(_DOPING_DEFINITIONS_COMMENT, newline=False)
+        self.writelines((definitions, "\n"))
 
-        statements = statements + self._doping_assignments(region_doping, doping_types)
-        statements = statements + "\n"
-        
-        if write_to_file:
-            self.write(statements)
-            return None
-        else:
-            return statements
+        if self.comment:
+            self.write(_DOPING_ASSIGNMENTS_COMMENT, newline=False)
+        self.writelines((assignments, "\n"))
+        return None
 
     def _constant_doping_definitions(self, doping_types, p_dopant="BoronActiveConcentration", n_dopant="PhosphorusActiveConcentration"):
         """ Generates the statements for the doping definitions
@@ -253,7 +360,8 @@ class SDE_generator():
         :param p_dopant: type of p dopant. For Si, available is either "BoronActiveConcentration"
         :param n_dopant: type of n dopant. For Si, available is either "PhosphorusActiveConcentration" or "ArsenicActiveConcentration"
         """
-        statements = ""
+        parts = []
+        append = parts.append
 
         self.doping_types = doping_types
         for dop_name, dop_desc in doping_types.items():
@@ -262,8 +370,8 @@ class SDE_generator():
             
             if not isinstance(dop_conc, str):
                 dop_conc = format(dop_conc, '.3e')
-            statements = statements + '(sdedr:define-constant-profile "%s"  %s %s) \n' % (dop_name, dopant, dop_conc)
-        return statements
+            append('(sdedr:define-constant-profile "%s"  %s %s) \n' % (dop_name, dopant, dop_conc))
+        return "".join(parts)
 
     def _doping_assignments(self, region_doping):
         """ Generates the assignments for assignment of dopings to regions.
@@ -272,13 +380,14 @@ class SDE_generator():
             Example: {"middle_spoke": "P_doping", "outer_spoke": "N++_doping"}
         """
 
-        statements = ""
+        parts = []
+        append = parts.append
         for region, dop_type in region_doping.items():
             if dop_type not in self.doping_types:
                 raise ValueError('The specified doping type %s is not defined' % dop_type)
-            statements = statements + '(sdedr:define-constant-profile-region "%s" "%s" "%s") \n' % (region[:-1], dop_type, region)
+            append('(sdedr:define-constant-profile-region "%s" "%s" "%s") \n' % (region[:-1], dop_type, region))
 
-        return statements
+        return "".join(parts)
 
     ######################### GEOMETRIC STRUCTURES #########################
 
@@ -300,10 +409,7 @@ class SDE_generator():
         p1_str = self._point_to_str(p1)
         p2_str = self._point_to_str(p2)
 
-        if self.sim_type == "2D":
-            statement = '(sdegeo:create-rectangle (position %s) (position %s) "%s" "%s")' % (p1_str, p2_str, material, region_name)
-        else:
-            statement = '(sdegeo:create-cuboid (position %s) (position %s) "%s" "%s")' % (p1_str, p2_str, material, region_name)
+        statement = f'(sdegeo:{self._rectangle_cmd} (position {p1_str}) (position {p2_str}) "{material}" "{region_name}")'
 
         if write_to_file:
             self.write(statement)
@@ -327,7 +433,7 @@ class SDE_generator():
 
         p_str = self._point_to_str(center_pos)
 
-        statement = '(sdegeo:create-reg-polygon (position %s) %.3e %d %.3e "%s" "%s")' % (p_str, radius, n_faces, start_angle, material, region_name)
+        statement = f'(sdegeo:create-reg-polygon (position {p_str}) {radius:.3e} {int(n_faces)} {start_angle:.3e} "{material}" "{region_name}")'
 
         if write_to_file:
             self.write(statement)
@@ -347,13 +453,10 @@ class SDE_generator():
         :param write_to_file: if True, it writes the satements to the file. If False, it just returns the statements.
         """
 
-        points_str = ""
-
-        for p in point_list:
-            p_str = self._point_to_str(p)
-            points_str = points_str + " (position %s) " % p_str
+        pt = self._point_to_str
+        points_str = "".join(f" (position {pt(p)}) " for p in point_list)
 
-        statement = '(sdegeo:create-polygon (list %s) "%s" "%s")' % (points_str, material, region_name)
+        statement = f'(sdegeo:create-polygon (list {points_str}) "{material}" "{region_name}")'
   
         if write_to_file:
             self.write(statement)
@@ -375,10 +478,7 @@ class SDE_generator():
 
         p_str = self._point_to_str(center_pos)
 
-        if self.sim_type == '2D':
-            statement = '(sdegeo:create-circular-sheet (position %s) %.3e "%s" "%s")' % (p_str, radius, material, region_name)
-        else:
-            statement = '(sdegeo:create-sphere (position %s) %.3e "%s" "%s")' % (p_str, radius, material, region_name)
+        statement = f'(sdegeo:{self._circle_cmd} (position {p_str}) {radius:.3e} "{material}" "{region_name}")'
 
         if write_to_file:
             self.write(statement)
@@ -402,7 +502,7 @@ class SDE_generator():
 
         p_str = self._point_to_str(pos)
 
-        statement = "(sdegeo:insert-vertex (position %s))" % p_str
+        statement = f"(sdegeo:insert-vertex (position {p_str}))"
 
         if write_to_file:
             self.write(statement)
@@ -420,27 +520,29 @@ class SDE_generator():
         :param write_to_file: if True, it writes the satements to the file. If False, it just returns the statements.
         """
 
-        statements = ""
-
-        if self.comment and write_to_file:
-            statements = statements + "; ******************\n"
-            statements = statements + "; DEFINE THE CONTACTS\n"
+        parts = []
+        append = parts.append
+        pt = self._point_to_str
 
         for contact_name, contact_point in contact_dict.items():
 
-            statements = statements + '(sdegeo:define-contact-set "%s" 4 (color:rgb 1 0 0) "##") \n' % contact_name  
+            append(f'(sdegeo:define-contact-set "{contact_name}" 4 (color:rgb 1 0 0) "##") \n')
                 # The 4 sets the thickness of the line
-            statements = statements + '(sdegeo:set-current-contact-set "%s") \n'  % contact_name
+            append(f'(sdegeo:set-current-contact-set "{contact_name}") \n')
 
-            p_str = self._point_to_str(contact_point)
+            p_str = pt(contact_point)
 
             if self.sim_type == '2D':
-                statements = statements + '(sdegeo:define-2d-contact (find-edge-id (position %s) "%s") \n\n' % (p_str, contact_name)
+                append(f'(sdegeo:define-2d-contact (find-edge-id (position {p_str}) "{contact_name}") \n\n')
 
             else:
-                statements = statements + '(sdegeo:set-contact-faces (find-face-id (position %s) "%s") \n\n' % (p_str, contact_name)
+                append(f'(sdegeo:set-contact-faces (find-face-id (position {p_str}) "{contact_name}") \n\n')
+
+        statements = "".join(parts)
 
         if write_to_file:
+            if self.comment:
+                self.write(_CONTACTS_COMMENT, newline=False)
             self.write(statements)
             return None
         else:
@@ -463,42 +565,39 @@ class SDE_generator():
         :param write_to_file: if True, it writes the satements to the file. If False, it just returns the statements.
         """
         
-        statements = ""
+        parts = []
+        append = parts.append
 
         if self.comment and write_to_file:
-            statements = statements + "; ******************\n"
-            statements = statements + "; MESHING \n\n"
+            append(_MESHING_COMMENT)
         
         # Define the region
         p1_str = self._point_to_str(p1)
         p2_str = self._point_to_str(p2)
 
         if self.sim_type == '2D':
-            statements = statements + '(sdedr:define-refinement-window  "RefWin.%s"  "Rectangle"  (position %s) (position %s)) \n\n' % (name, p1_str, p2_str)
+            append(f'(sdedr:define-refinement-window  "RefWin.{name}"  "Rectangle"  (position {p1_str}) (position {p2_str})) \n\n')
         else:
-            statements = statements + '(sdedr:define-refinement-window  "RefWin.%s"  "Cuboid"  (position %s) (position %s)) \n\n' % (name, p1_str, p2_str)
+            append(f'(sdedr:define-refinement-window  "RefWin.{name}"  "Cuboid"  (position {p1_str}) (position {p2_str})) \n\n')
 
         # Specify max and min lengths
         if self.sim_type == '2D':
-            max_min_str = "%.3e %.3e %.3e %.3e" % (sizes[0], sizes[2], sizes[1], sizes[3])  # xmax ymax xmin ymin
+            max_min_str = f"{sizes[0]:.3e} {sizes[2]:.3e} {sizes[1]:.3e} {sizes[3]:.3e}"  # xmax ymax xmin ymin
         else:
-            max_min_str = "%.3e %.3e %.3e %.3e %.3e %.3e" % (sizes[0], sizes[2], sizes[4], sizes[1], sizes[3], sizes[5])  # xmax ymax zmax xmin ymin zmin
+            max_min_str = f"{sizes[0]:.3e} {sizes[2]:.3e} {sizes[4]:.3e} {sizes[1]:.3e} {sizes[3]:.3e} {sizes[5]:.3e}"  # xmax ymax zmax xmin ymin zmin
 
-        statements = statements + '(sdedr:define-refinement-size "RefDef.%s" %s) \n\n' % (name, max_min_str)
+        append(f'(sdedr:define-refinement-size "RefDef.{name}" {max_min_str}) \n\n')
 
         # Now write the refinements
         for refinement in refinements:
-            statements = statements + '(sdedr:define-refinement-function "RefDef.%s" ' % name
-            for ref_param in refinement:
-                if isinstance(ref_param, str):
-                    statements = statements + '"%s" ' % ref_param
-                else:
-                    statements = statements + '%.2e ' % ref_param
-            
-            statements = statements + ') \n\n'
+            # Strings are quoted and numbers formatted, all in a single format operation
+            spec = "".join('"%s" ' if isinstance(ref_param, str) else '%.2e ' for ref_param in refinement)
+            append(f'(sdedr:define-refinement-function "RefDef.{name}" ' + spec % tuple(refinement) + ') \n\n')
 
         # Finally, actually apply the mesh
-        statements = statements + '(sdedr:define-refinement-placement  "PlaceRF.%s"  "RefDef.%s"  "RefWin.%s") \n\n' % (name, name, name)
+        append(f'(sdedr:define-refinement-placement  "PlaceRF.{name}"  "RefDef.{name}"  "RefWin.{name}") \n\n')
+
+        statements = "".join(parts)
 
         if write_to_file:
             self.write(statements)
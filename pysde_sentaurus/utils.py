@@ -1,4 +1,4 @@
-import re
+import functools
 
 # precedence level of supported operators.
 PRECEDENCE = {
@@ -13,6 +13,45 @@ PRECEDENCE = {
     '(': 1,
 }
 
+# characters that are tokens on their own (operators and parentheses).
+OPS = frozenset("()^+*-/=><")
+
+# non-alphanumeric characters allowed inside operands (ex: 3.2e4, outer_spoke_l).
+_OPERAND_PUNCT = frozenset("._")
+
+# translation table that swaps parentheses, used when reversing an expression.
+_PAREN_SWAP = str.maketrans("()", ")(")
+
+def _tokenize(expr):
+    """ Splits an expression into operands and operators in a single pass.
+
+    :param expr: string with the expression in regular order.
+    """
+
+    i = 0
+    n = len(expr)
+    out = []
+    append = out.append
+    while i < n:
+        c = expr[i]
+        if c in OPS:
+            append(c)
+            i += 1
+            continue
+
+        # Operands are runs of alphanumeric characters, '.' and '_'.
+        # Anything else (whitespace, commas...) is skipped.
+        j = i
+        while j < n and (expr[j].isalnum() or expr[j] in _OPERAND_PUNCT):
+            j += 1
+        if j == i:
+            i += 1
+        else:
+            append(expr[i:j])
+            i = j
+    return out
+
+@functools.lru_cache(maxsize=4096)
 def infix_to_postfix(expr):
     """ Converts to reverse polish notation.
 
@@ -21,57 +60,58 @@ def infix_to_postfix(expr):
     :param expr: string with the expression in regular order.
     """
 
-    tokens = re.findall(r"(\b\w*[\.]?\w+\b|[\(\)\^\+\*\-\/\=\>\<])", expr)
+    tokens = _tokenize(expr)
     stack = []
     postfix = []
+    # Bind the list methods locally to avoid the attribute lookups in the loop
+    stack_append = stack.append
+    stack_pop = stack.pop
+    postfix_append = postfix.append
+    precedence = PRECEDENCE
     
     for token in tokens:
         # If the token is an operand, then do not push it to stack. 
-        # Instead, pass it to the output.
-        if re.match(r'^[A-Za-z0-9_.]+$', token):
-            postfix.append(token)
+        # Instead, pass it to the output. This is the most common case,
+        # so it is tested first with a single set lookup.
+        if token not in OPS:
+            postfix_append(token)
+            continue
     
         # If your current token is a right parenthesis
         # push it on to the stack
-        elif token == '(':
-            stack.append(token)
+        if token == '(':
+            stack_append(token)
 
         # If your current token is a right parenthesis,
         # pop the stack until after the first left parenthesis.
         # Output all the symbols except the parentheses.
         elif token == ')':
-            top = stack.pop()
+            top = stack_pop()
             while top != '(':
-                postfix.append(top)
-                top = stack.pop()
+                postfix_append(top)
+                top = stack_pop()
 
         # Before you can push the operator onto the stack, 
         # you have to pop the stack until you find an operator
         # with a lower priority than the current operator.
         # The popped stack elements are written to output.
         else:
-            while stack and (PRECEDENCE[stack[-1]] >= PRECEDENCE[token]):
-                postfix.append(stack.pop())
-            stack.append(token)
+            while stack and (precedence[stack[-1]] >= precedence[token]):
+                postfix_append(stack_pop())
+            stack_append(token)
 
     # After the entire expression is scanned, 
     # pop the rest of the stack 
     # and write the operators in the stack to the output.
     while stack:
-        postfix.append(stack.pop())
+        postfix_append(stack_pop())
     return ' '.join(postfix)
 
 
+@functools.lru_cache(maxsize=4096)
 def infix_to_prefix(expr):
 
-    reverse_expr =''
-    for c in expr[::-1]:
-        if c == '(':
-            reverse_expr += ")"
-        elif c == ')':
-            reverse_expr += "("
-        else:
-            reverse_expr += c
+    reverse_expr = expr[::-1].translate(_PAREN_SWAP)
 
     reverse_postfix = infix_to_postfix(reverse_expr)
 